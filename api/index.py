@@ -1,18 +1,29 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 import os
+import sys
 import re
 import time
 import random
 import io
 import tempfile
-from datetime import datetime
+import hashlib
+import secrets
+import bisect
+import json
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import fitz 
+import httpx
 import google.generativeai as genai
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception_type, retry_if_not_exception_type, stop_after_attempt, wait_exponential
 from elevenlabs.client import ElevenLabs
 from google.api_core.exceptions import BadRequest
 import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -21,10 +32,13 @@ CORS(app)
 # Use /tmp for Vercel serverless functions
 UPLOAD_FOLDER = '/tmp/uploads'
 OUTPUT_FOLDER = '/tmp/output'
+LLM_CACHE_FOLDER = '/tmp/llm_cache'
+LLM_CACHE_MAX_BYTES = 32 * 1024 * 1024
 ALLOWED_EXTENSIONS = {'pdf'}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(LLM_CACHE_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
@@ -34,12 +48,65 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY", "")
 
+SUMMARY_INSTRUCTION = (
+    "Summarize the following academic content in a concise, "
+    "concept-focused manner. Preserve key ideas."
+)
+
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
     model = genai.GenerativeModel("gemini-1.5-flash")
+    # The summary instruction is identical for every page, so it lives on the
+    # model as a system instruction instead of being resent in each prompt.
+    summary_model = genai.GenerativeModel(
+        "gemini-1.5-flash",
+        system_instruction=SUMMARY_INSTRUCTION
+    )
+
+class ElevenLabsRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"ElevenLabs rate limit exceeded (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+def parse_retry_after(headers):
+    if headers.get('retry-after-ms'):
+        try:
+            return min(max(float(headers['retry-after-ms']) / 1000, 0), ELEVEN_MAX_RETRY_AFTER)
+        except ValueError:
+            pass
+    
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), ELEVEN_MAX_RETRY_AFTER)
+
+def raise_on_rate_limit(response):
+    # The SDK's ApiError keeps only the status code and body, so 429s are
+    # caught here while the response headers are still available.
+    if response.status_code == 429:
+        raise ElevenLabsRateLimited(parse_retry_after(response.headers))
 
 if ELEVENLABS_API_KEY:
-    eleven_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+    # One pooled client keeps TLS connections alive across the many TTS calls
+    # (and the voice catalog / fallback convert requests) of each task.
+    # The SDK applies its own per-request timeout, so it is set here rather
+    # than on the httpx client.
+    eleven_http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        event_hooks={'response': [raise_on_rate_limit]}
+    )
+    eleven_client = ElevenLabs(
+        api_key=ELEVENLABS_API_KEY,
+        httpx_client=eleven_http_client,
+        timeout=240
+    )
 
 NUM_HOSTS = 2
 NUM_GUESTS = 1
@@ -48,83 +115,419 @@ NAME_POOL = [
     "Riley", "Dakota", "Harper", "Quinn", "Reese"
 ]
 MIN_SPLIT_SIZE = 1000
+SPLIT_CHUNK_SIZE = MIN_SPLIT_SIZE * 8
+# sched_getaffinity respects container/lambda CPU quotas; cpu_count does not.
+PDF_EXTRACT_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+# Extraction runs at roughly 1ms per text page, so a worker only pays for its
+# startup and pickling once it has hundreds of pages to process.
+PDF_EXTRACT_MIN_PAGES = 500
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", 8))
+SUMMARY_BATCH_CHARS = 40000
+SUMMARY_BATCH_PAGES = 20
+SUMMARY_MAX_CHARS = 2000
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", 6))
+ELEVEN_MAX_CONCURRENT = int(os.environ.get("ELEVEN_MAX_CONCURRENT", 6))
+ELEVEN_MAX_RETRY_AFTER = 60
+eleven_semaphore = threading.BoundedSemaphore(ELEVEN_MAX_CONCURRENT)
 AVERAGE_WPM = 150.0
 
-processing_status = {}
+extract_pool = {"executor": None}
+extract_pool_lock = threading.Lock()
+
+llm_cache_state = {"bytes": None}
+llm_cache_lock = threading.Lock()
+
+VOICES_CACHE_TTL = 3600
+voices_cache = {"data": None, "ts": 0}
+voices_lock = threading.Lock()
+
+# Layer III tables for locating and sizing the first frame of a segment.
+MP3_SCAN_BYTES = 4096
+MP3_BITRATES_MPEG1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MP3_BITRATES_MPEG2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000]
+}
+
+# Compiled once at import; these run for every page and every script line.
+SENTENCE_END_RE = re.compile(r"\.\s")
+OVERSIZE_ERROR_RE = re.compile(r"token count|exceeds the maximum|too large|too long", re.IGNORECASE)
+SECTION_RE = re.compile(r"#+\s*Section\s+\d+\s*:?")
+STAR_RE = re.compile(r"\*+")
+SPEAKER_RE = re.compile(r"^([A-Za-z]+):\s*")
+
+# Podcast jobs run on a fixed pool of workers. pending_tasks counts running
+# plus queued jobs so uploads are refused once the queue is full.
+MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", 4))
+MAX_PENDING_TASKS = int(os.environ.get("MAX_PENDING_TASKS", 16))
+task_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS, thread_name_prefix="podcast")
+pending_tasks = threading.BoundedSemaphore(MAX_PENDING_TASKS)
+
+# Task state is shared between worker threads and request handlers, so every
+# access goes through status_lock. Only the most recent MAX_TRACKED_TASKS are
+# kept to stop warm instances from growing without bound. Each update bumps the
+# task's version and wakes any /events streams waiting on status_changed.
+MAX_TRACKED_TASKS = 256
+STATUS_KEEPALIVE = 15
+processing_status = OrderedDict()
+status_versions = {}
+status_lock = threading.Lock()
+status_changed = threading.Condition(status_lock)
+
+def create_status(task_id: str, **fields):
+    with status_lock:
+        processing_status[task_id] = fields
+        status_versions[task_id] = 0
+        while len(processing_status) > MAX_TRACKED_TASKS:
+            evicted_id, _ = processing_status.popitem(last=False)
+            status_versions.pop(evicted_id, None)
+
+def update_status(task_id: str, **fields):
+    with status_lock:
+        if task_id in processing_status:
+            processing_status[task_id].update(fields)
+            status_versions[task_id] += 1
+            status_changed.notify_all()
+
+def get_task_status(task_id: str):
+    with status_lock:
+        task = processing_status.get(task_id)
+        return dict(task) if task is not None else None
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-def call_gemini(prompt: str) -> str:
+# Identical prompts (re-uploaded PDFs, repeated boilerplate pages) are served
+# from /tmp instead of going back to Gemini. Entries are keyed by a caller-chosen
+# namespace plus the prompt, and the folder is trimmed oldest-first once it
+# passes LLM_CACHE_MAX_BYTES since /tmp also holds uploads and audio.
+def llm_cache_path(namespace: str, prompt: str) -> str:
+    key_source = f"{namespace}\0{prompt}".encode()
+    key = hashlib.blake2b(key_source, digest_size=16).hexdigest()
+    return os.path.join(LLM_CACHE_FOLDER, key)
+
+def load_cached_response(namespace: str, prompt: str):
+    cache_path = llm_cache_path(namespace, prompt)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cached:
+            text = cached.read()
+        # Refresh the mtime so trimming evicts least recently used entries.
+        os.utime(cache_path)
+        return text
+    except OSError:
+        return None
+
+def store_cached_response(namespace: str, prompt: str, text: str):
+    # Write to a temp file and rename so concurrent readers never see a
+    # partially written entry. A failed write (e.g. a full /tmp) only costs
+    # the cache entry, never the response itself.
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_FOLDER, prefix='.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+            tmp_file.write(text)
+        os.replace(tmp_path, llm_cache_path(namespace, prompt))
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return
+    trim_llm_cache(len(text.encode('utf-8')))
+
+def trim_llm_cache(added_bytes: int):
+    with llm_cache_lock:
+        if llm_cache_state["bytes"] is not None:
+            llm_cache_state["bytes"] += added_bytes
+            if llm_cache_state["bytes"] <= LLM_CACHE_MAX_BYTES:
+                return
+        
+        entries = []
+        for entry in os.scandir(LLM_CACHE_FOLDER):
+            # Names starting with '.' are writes still in progress.
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        
+        total = sum(size for mtime, size, path in entries)
+        if total > LLM_CACHE_MAX_BYTES:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= LLM_CACHE_MAX_BYTES * 3 // 4:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+        llm_cache_state["bytes"] = total
+
+def cached_call_gemini(prompt: str, namespace: str, gemini_model=None) -> str:
+    text = load_cached_response(namespace, prompt)
+    if text is None:
+        text = call_gemini(prompt, gemini_model)
+        if text:
+            store_cached_response(namespace, prompt, text)
+    return text
+
+# BadRequest is not transient; surface it unwrapped so callers can split.
+@retry(
+    retry=retry_if_not_exception_type(BadRequest),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    reraise=True
+)
+def call_gemini(prompt: str, gemini_model=None) -> str:
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY not configured")
-    response = model.generate_content(prompt)
+    response = (gemini_model or model).generate_content(prompt)
     text = response.text or ""
     return text.strip()
 
-def split_on_sentence_boundary(text: str) -> tuple[str, str]:
-    mid = len(text) // 2
-    idx = text.rfind(". ", 0, mid)
-    if idx == -1:
-        return text[:mid].strip(), text[mid:].strip()
-    else:
-        return text[: idx + 1].strip(), text[idx + 1 :].strip()
+def split_on_sentence_boundary(text: str, chunk_size: int) -> list[str]:
+    # Cut into ceil(len / chunk_size) near-equal chunks, moving each cut to the
+    # closest sentence end within half a chunk of its ideal position (or
+    # hard-cutting when there is none), so no one-sentence scraps are left.
+    count = -(-len(text) // chunk_size)
+    target = len(text) / count
+    boundaries = [match.end() for match in SENTENCE_END_RE.finditer(text)]
+    chunks = []
+    start = 0
+    for k in range(1, count):
+        ideal = round(k * target)
+        cut = ideal
+        index = bisect.bisect_left(boundaries, ideal)
+        candidates = [b for b in boundaries[max(index - 1, 0):index + 1] if start < b < len(text)]
+        if candidates:
+            nearest = min(candidates, key=lambda b: abs(b - ideal))
+            if abs(nearest - ideal) <= target / 2:
+                cut = nearest
+        if cut <= start:
+            continue
+        chunks.append(text[start:cut].strip())
+        start = cut
+    chunks.append(text[start:].strip())
+    return [chunk for chunk in chunks if chunk]
 
-def recursive_summarize(text: str) -> str:
-    prompt = (
-        "Summarize the following academic content in a concise, "
-        "concept-focused manner. Preserve key ideas:\n\n"
-        f"{text}"
-    )
+def summarize_snippet(text: str) -> str:
+    truncated = text[: min(len(text), MIN_SPLIT_SIZE)]
     try:
-        return call_gemini(prompt)
-    except BadRequest as e:
-        if len(text) < MIN_SPLIT_SIZE:
-            truncated = text[: min(len(text), MIN_SPLIT_SIZE)]
-            try:
-                return call_gemini(
-                    "Summarize this small snippet concisely:\n\n" + truncated
-                )
-            except Exception:
-                return truncated[:500] + "..."
-        left, right = split_on_sentence_boundary(text)
-        left_sum = recursive_summarize(left)
-        right_sum = recursive_summarize(right)
-        return f"{left_sum} {right_sum}"
+        return cached_call_gemini(
+            "Summarize this small snippet concisely:\n\n" + truncated,
+            "snippet"
+        )
+    except Exception:
+        return truncated[:500] + "..."
 
-def process_pdf_to_summary(pdf_path: str, task_id: str) -> str:
-    processing_status[task_id]['status'] = 'Processing PDF...'
-    processing_status[task_id]['progress'] = 10
-    
+def is_oversize_request(error: BadRequest) -> bool:
+    # BadRequest covers every HTTP 400 (bad API key, unsupported region, ...);
+    # only a rejection for input size is worth splitting the text over.
+    return bool(OVERSIZE_ERROR_RE.search(str(error)))
+
+def summarize_text(text: str) -> str:
+    # Pieces Gemini rejects as too large are split on sentence boundaries
+    # (into chunks of at most SPLIT_CHUNK_SIZE, then in halves) and retried in
+    # order until they fit or drop below MIN_SPLIT_SIZE. Any other BadRequest
+    # is re-raised so the caller falls back once. The pieces run serially
+    # because this already executes inside a SUMMARY_WORKERS thread; a nested
+    # pool would multiply the number of concurrent Gemini calls per task.
+    summaries = []
+    pending = deque([text])
+    while pending:
+        piece = pending.popleft()
+        try:
+            summaries.append(cached_call_gemini(piece, "summary", summary_model))
+        except BadRequest as e:
+            if not is_oversize_request(e):
+                raise
+            if len(piece) < MIN_SPLIT_SIZE:
+                summaries.append(summarize_snippet(piece))
+                continue
+            chunk_size = min(SPLIT_CHUNK_SIZE, -(-len(piece) // 2))
+            pending.extendleft(reversed(split_on_sentence_boundary(piece, chunk_size)))
+    return " ".join(summaries)
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> list[tuple[int, str]]:
+    pages = []
     with fitz.open(pdf_path) as doc:
-        all_summaries = []
-        total_pages = len(doc)
-        
-        for page_num, page in enumerate(doc, start=1):
-            raw_text = page.get_text("text").strip()
-            page_text = re.sub(r"\s+", " ", raw_text)
+        for page_num in range(start, stop):
+            # Text blocks only (type 0); image blocks carry placeholder text.
+            page = doc[page_num]
+            blocks = [block[4] for block in page.get_text("blocks") if block[6] == 0]
+            del page
+            
+            # Normalizing whitespace only shrinks the text, so pages that are
+            # already too short raw are dropped before building any string.
+            if sum(len(block) for block in blocks) < 50:
+                continue
             
+            page_text = " ".join(word for block in blocks for word in block.split())
             if len(page_text) < 50:
                 continue
             
-            processing_status[task_id]['status'] = f'Summarizing page {page_num}/{total_pages}...'
-            processing_status[task_id]['progress'] = 10 + (page_num / total_pages) * 30
+            pages.append((page_num + 1, page_text))
+    return pages
+
+def get_extract_pool():
+    # One pool for the whole process, started lazily. Workers come from a
+    # forkserver rather than fork() so they never inherit this multithreaded
+    # server's gRPC channels, HTTP pools or held locks.
+    with extract_pool_lock:
+        if extract_pool["executor"] is None:
+            extract_pool["executor"] = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+        return extract_pool["executor"]
+
+def extract_pages(pdf_path: str) -> tuple[int, list[tuple[int, str]]]:
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    
+    workers = min(PDF_EXTRACT_WORKERS, total_pages // PDF_EXTRACT_MIN_PAGES)
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        workers = 1
+    if workers <= 1:
+        pages = extract_page_range(pdf_path, 0, total_pages)
+    else:
+        # PyMuPDF is not thread-safe, so each worker process opens its own copy
+        # of the document and extracts a contiguous range of pages.
+        step = -(-total_pages // workers)
+        starts = list(range(0, total_pages, step))
+        stops = [min(start + step, total_pages) for start in starts]
+        try:
+            chunks = get_extract_pool().map(extract_page_range, [pdf_path] * len(starts), starts, stops)
+            pages = [page for chunk in chunks for page in chunk]
+        except (OSError, BrokenProcessPool):
+            # Some serverless runtimes (no /dev/shm) cannot start a process
+            # pool; drop the broken one and extract serially.
+            with extract_pool_lock:
+                extract_pool["executor"] = None
+            pages = extract_page_range(pdf_path, 0, total_pages)
+    
+    # Closing the document does not empty MuPDF's global resource store
+    # (fonts, images, display lists); drop it before the long network phases.
+    fitz.TOOLS.store_shrink(100)
+    return total_pages, pages
+
+def summarize_page(text: str) -> str:
+    try:
+        return summarize_text(text)
+    except Exception:
+        return text[:500] + "..."
+
+def batch_pages(texts: list[str]) -> list[list[str]]:
+    batches = []
+    current = []
+    current_size = 0
+    for text in texts:
+        if current and (current_size + len(text) > SUMMARY_BATCH_CHARS
+                        or len(current) >= SUMMARY_BATCH_PAGES):
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(text)
+        current_size += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_batch_summaries(response: str, count: int):
+    summaries = [part.strip() for part in SECTION_RE.split(response)[1:]]
+    if len(summaries) == count and all(summaries):
+        return summaries
+    return None
+
+def summarize_batch(texts: list[str]) -> list[str]:
+    if len(texts) == 1:
+        return [summarize_page(texts[0])]
+    
+    sections = "\n\n".join(
+        f"### Section {k}\n{text}" for k, text in enumerate(texts, start=1)
+    )
+    prompt = (
+        f"For each of the following {len(texts)} sections, produce a concise "
+        "summary prefixed with '### Section k', where k is the section number.\n\n"
+        f"{sections}"
+    )
+    cached = load_cached_response("batch", prompt)
+    if cached is not None:
+        summaries = parse_batch_summaries(cached, len(texts))
+        if summaries is not None:
+            return summaries
+    
+    try:
+        response = call_gemini(prompt, summary_model)
+        summaries = parse_batch_summaries(response, len(texts))
+        if summaries is not None:
+            # Only well-formed responses are cached; a malformed one would
+            # otherwise force the per-page fallback on every re-upload.
+            store_cached_response("batch", prompt, response)
+            return summaries
+    except BadRequest:
+        pass
+    except Exception:
+        # Transient failures (rate limits, timeouts) already exhausted
+        # call_gemini's retries; fanning out per page would only repeat them.
+        return [text[:500] + "..." for text in texts]
+    
+    # The batch was rejected or came back malformed; summarize page by page.
+    return [summarize_page(text) for text in texts]
+
+def process_pdf_to_summary(pdf_path: str, task_id: str) -> str:
+    update_status(task_id, status='Processing PDF...', progress=10)
+    
+    total_pages, pages = extract_pages(pdf_path)
+    # Only the extracted text is needed from here on, so free the upload.
+    os.remove(pdf_path)
+    
+    if not pages:
+        raise RuntimeError("No valid pages found in PDF.")
+    
+    update_status(task_id, status=f'Summarizing {len(pages)}/{total_pages} pages...')
+    
+    # Pages are grouped into batches that each cost one Gemini round-trip,
+    # and the batches are dispatched concurrently. Results are slotted back
+    # into page order as they complete.
+    batches = batch_pages([page_text for page_num, page_text in pages])
+    completed = 0
+    with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+        futures = {
+            executor.submit(summarize_batch, batch): batch_index
+            for batch_index, batch in enumerate(batches)
+        }
+        batch_summaries = [None] * len(batches)
+        for future in as_completed(futures):
+            batch_index = futures[future]
+            batch_summaries[batch_index] = future.result()
             
-            try:
-                page_summary = recursive_summarize(page_text)
-                all_summaries.append(page_summary)
-                time.sleep(1)
-            except Exception as e:
-                fallback = page_text[:500] + "..."
-                all_summaries.append(fallback)
-        
-        if not all_summaries:
-            raise RuntimeError("No valid pages found in PDF.")
-        
-        concatenated = " ".join(all_summaries)
-        final_summary = concatenated[:2000]
-        return final_summary
+            completed += len(batches[batch_index])
+            update_status(
+                task_id,
+                status=f'Summarized {completed}/{len(pages)} pages...',
+                progress=10 + (completed / len(pages)) * 30
+            )
+    
+    # Only the first SUMMARY_MAX_CHARS survive, so stop collecting once the
+    # budget is met rather than joining every page summary.
+    kept = []
+    total = 0
+    for summaries in batch_summaries:
+        for summary in summaries:
+            if total > SUMMARY_MAX_CHARS:
+                break
+            kept.append(summary)
+            total += len(summary) + 1
+    
+    final_summary = " ".join(kept)[:SUMMARY_MAX_CHARS]
+    return final_summary
 
 def pick_random_names(num_total, pool, selected_names=None):
     if selected_names and len(selected_names) > 0:
@@ -138,12 +541,14 @@ def pick_random_names(num_total, pool, selected_names=None):
     else:
         return random.sample(pool, k=num_total)
 
-def build_voice_settings(speakers):
-    if not ELEVENLABS_API_KEY:
-        raise RuntimeError("ELEVENLABS_API_KEY not configured")
+def get_available_voices():
+    # The voice catalog rarely changes, so one fetch is shared across tasks
+    # for VOICES_CACHE_TTL seconds. Holding the lock while fetching means
+    # concurrent tasks wait for a single request instead of each sending one.
+    with voices_lock:
+        if voices_cache["data"] is not None and time.time() - voices_cache["ts"] < VOICES_CACHE_TTL:
+            return voices_cache["data"]
         
-    settings = {}
-    try:
         voices_response = eleven_client.voices.get_all()
         
         if hasattr(voices_response, 'voices'):
@@ -160,6 +565,19 @@ def build_voice_settings(speakers):
                 if voice.get('voice_id') and voice.get('name'):
                     filtered.append(voice)
         
+        if filtered:
+            voices_cache["data"] = filtered
+            voices_cache["ts"] = time.time()
+        return filtered
+
+def build_voice_settings(speakers):
+    if not ELEVENLABS_API_KEY:
+        raise RuntimeError("ELEVENLABS_API_KEY not configured")
+        
+    settings = {}
+    try:
+        filtered = get_available_voices()
+        
         if not filtered:
             fallback_voices = [
                 {"voice_id": "21m00Tcm4TlvDq8ikWAM", "name": "Rachel"},
@@ -204,12 +622,12 @@ def build_voice_settings(speakers):
         return settings
 
 def generate_podcast_script(summary: str, speakers: list[str], task_id: str) -> str:
-    processing_status[task_id]['status'] = 'Generating podcast script...'
-    processing_status[task_id]['progress'] = 45
+    update_status(task_id, status='Generating podcast script...', progress=45)
     
-    num_hosts = processing_status[task_id]['num_hosts']
-    num_guests = processing_status[task_id]['num_guests']
-    podcast_length = processing_status[task_id]['podcast_length']
+    task = get_task_status(task_id)
+    num_hosts = task['num_hosts']
+    num_guests = task['num_guests']
+    podcast_length = task['podcast_length']
     
     hosts = speakers[:num_hosts]
     guests = speakers[num_hosts:num_hosts + num_guests] if num_guests > 0 else []
@@ -245,61 +663,163 @@ Guidelines:
     return script_text
 
 def clean_line(line: str) -> str:
-    return re.sub(r"\*+", "", line).strip()
+    return STAR_RE.sub("", line).strip()
 
-def is_dialogue_line(line: str, speakers_lower: set[str]) -> bool:
-    lower = line.lower().lstrip()
-    return any(lower.startswith(f"{speaker}:") for speaker in speakers_lower)
+def split_dialogue(line: str, voice_settings: dict):
+    # Only the speaker token is lowercased, never the whole line.
+    match = SPEAKER_RE.match(line)
+    if not match:
+        return None
+    cfg = voice_settings.get(match.group(1).lower())
+    if cfg is None:
+        return None
+    return cfg, line[match.end():]
 
-def get_voice_settings_for_line(line: str, voice_settings: dict) -> dict:
-    lower = line.lower()
-    for name, cfg in voice_settings.items():
-        if lower.startswith(f"{name}:"):
-            return cfg
-    return {"voice_id": None, "voice_name": None}
+def wait_for_rate_limit(retry_state):
+    # Sleep for as long as ElevenLabs asked; only guess when it didn't say.
+    seconds = retry_state.outcome.exception().retry_after
+    if seconds is None:
+        return wait_exponential(multiplier=1, min=2, max=30)(retry_state)
+    return seconds + random.uniform(0, 1)
 
-def strip_speaker_label(line: str) -> str:
-    return re.sub(r"^[A-Za-z]+:\s*", "", line)
-
-def text_to_audio_elevenlabs(text: str, voice_id: str) -> bytes:
+@retry(
+    retry=retry_if_exception_type(ElevenLabsRateLimited),
+    wait=wait_for_rate_limit,
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+def text_to_audio_elevenlabs(text: str, voice_id: str, out_fh) -> None:
     if not ELEVENLABS_API_KEY:
         raise RuntimeError("ELEVENLABS_API_KEY not configured")
-        
-    try:
-        audio_generator = eleven_client.generate(
-            text=text,
-            voice=voice_id,
-            model="eleven_flash_v2_5"
-        )
-        
-        audio_data = b"".join(audio_generator)
-        return audio_data
-        
-    except Exception as e:
+    
+    # Chunks are written as they arrive so a line's audio is never held in
+    # memory; remember where we started in case the fallback has to rewrite.
+    # The semaphore caps in-flight requests across all running tasks.
+    start = out_fh.tell()
+    with eleven_semaphore:
         try:
-            stream = eleven_client.text_to_speech.convert(
+            audio_generator = eleven_client.generate(
                 text=text,
-                voice_id=voice_id,
-                model_id="eleven_flash_v2_5",
-                output_format="mp3_44100_128",
-                voice_settings={
-                    "stability": 0.3,
-                    "similarity_boost": 0.6,
-                    "style": 0.1,
-                    "use_speaker_boost": False
-                }
+                voice=voice_id,
+                model="eleven_flash_v2_5",
+                stream=True
             )
-            data = b"".join(stream)
-            return data
-        except Exception as e2:
-            print(f"Audio generation failed: {e2}")
-            raise e2
+            
+            for chunk in audio_generator:
+                out_fh.write(chunk)
+            
+        except ElevenLabsRateLimited:
+            # The fallback would hit the same quota; let the retry wait.
+            out_fh.seek(start)
+            out_fh.truncate()
+            raise
+        except Exception:
+            out_fh.seek(start)
+            out_fh.truncate()
+            try:
+                stream = eleven_client.text_to_speech.convert(
+                    text=text,
+                    voice_id=voice_id,
+                    model_id="eleven_flash_v2_5",
+                    output_format="mp3_44100_128",
+                    voice_settings={
+                        "stability": 0.3,
+                        "similarity_boost": 0.6,
+                        "style": 0.1,
+                        "use_speaker_boost": False
+                    }
+                )
+                for chunk in stream:
+                    out_fh.write(chunk)
+            except Exception as e2:
+                out_fh.seek(start)
+                out_fh.truncate()
+                print(f"Audio generation failed: {e2}")
+                raise e2
+
+def mp3_audio_ranges(segment_file, size: int, keep_id3: bool) -> list[tuple[int, int]]:
+    # Byte ranges of a segment worth keeping when stitching segments together:
+    # the optional leading ID3v2 tag plus the MPEG frames, minus any Xing/Info/
+    # VBRI header frame (it describes only this segment's duration) and any
+    # trailing ID3v1 tag.
+    end = size
+    if size >= 128:
+        segment_file.seek(size - 128)
+        if segment_file.read(3) == b'TAG':
+            end = size - 128
+    
+    segment_file.seek(0)
+    header = segment_file.read(10)
+    tag_end = 0
+    if len(header) == 10 and header[:3] == b'ID3':
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        tag_end = min(10 + tag_size + (10 if header[5] & 0x10 else 0), end)
+    
+    segment_file.seek(tag_end)
+    data = segment_file.read(MP3_SCAN_BYTES)
+    audio_start = None
+    for i in range(len(data) - 3):
+        if data[i] == 0xFF and data[i + 1] & 0xE0 == 0xE0:
+            audio_start = i
+            break
+    
+    if audio_start is None:
+        # No frame sync found; copy the segment untouched rather than guess.
+        return [(0, end)]
+    
+    frame = data[audio_start:]
+    version = (frame[1] >> 3) & 3
+    layer = (frame[1] >> 1) & 3
+    bitrate_index = frame[2] >> 4
+    sample_rate_index = (frame[2] >> 2) & 3
+    if layer == 1 and version != 1 and 0 < bitrate_index < 15 and sample_rate_index < 3:
+        mpeg1 = version == 3
+        mono = frame[3] >> 6 == 3
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        if frame[4 + side_info:8 + side_info] in (b'Xing', b'Info') or frame[36:40] == b'VBRI':
+            bitrates = MP3_BITRATES_MPEG1 if mpeg1 else MP3_BITRATES_MPEG2
+            sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+            padding = (frame[2] >> 1) & 1
+            audio_start += (144 if mpeg1 else 72) * bitrates[bitrate_index] * 1000 // sample_rate + padding
+    
+    audio_start = min(tag_end + audio_start, end)
+    ranges = [(0, tag_end)] if keep_id3 and tag_end else []
+    ranges.append((audio_start, end))
+    return ranges
+
+def append_segment(output_file, segment_path: str, keep_id3: bool = False):
+    with open(segment_path, 'rb') as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        ranges = mp3_audio_ranges(segment_file, size, keep_id3)
+        # Only Linux sendfile accepts a regular file as the destination; macOS
+        # and the BSDs require a socket (the same gate shutil uses).
+        if sys.platform.startswith('linux'):
+            # Copy in kernel space; the audio never passes through Python.
+            # Flush first so buffered writes land before the copied bytes.
+            output_file.flush()
+            for offset, stop in ranges:
+                while offset < stop:
+                    sent = os.sendfile(output_file.fileno(), segment_file.fileno(), offset, stop - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+        else:
+            for offset, stop in ranges:
+                segment_file.seek(offset)
+                remaining = stop - offset
+                while remaining > 0:
+                    chunk = segment_file.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    output_file.write(chunk)
+                    remaining -= len(chunk)
 
 def process_podcast_creation(pdf_path: str, task_id: str):
     try:
-        num_hosts = processing_status[task_id]['num_hosts']
-        num_guests = processing_status[task_id]['num_guests']
-        selected_hosts = processing_status[task_id]['selected_hosts']
+        task = get_task_status(task_id)
+        num_hosts = task['num_hosts']
+        num_guests = task['num_guests']
+        selected_hosts = task['selected_hosts']
         
         summary = process_pdf_to_summary(pdf_path, task_id)
         
@@ -309,43 +829,56 @@ def process_podcast_creation(pdf_path: str, task_id: str):
         
         script = generate_podcast_script(summary, speakers, task_id)
         
-        processing_status[task_id]['status'] = 'Converting to audio...'
-        processing_status[task_id]['progress'] = 60
+        update_status(task_id, status='Converting to audio...', progress=60)
         
-        audio_segments = []
-        speakers_lower = set(name.lower() for name in speakers)
-        
-        script_lines = [clean_line(line) for line in script.split("\n") if clean_line(line)]
-        total_lines = len([line for line in script_lines if is_dialogue_line(line, speakers_lower)])
-        processed_lines = 0
+        script_lines = [line for line in map(clean_line, script.split("\n")) if line]
         
+        # voice_settings is keyed by lowercase speaker name, so it doubles as
+        # the set of speakers whose lines should be voiced.
+        dialogue = []
         for line in script_lines:
-            if not line:
+            parsed = split_dialogue(line, voice_settings)
+            if parsed is None:
                 continue
             
-            if is_dialogue_line(line, speakers_lower):
-                cfg = get_voice_settings_for_line(line, voice_settings)
-                voice_id = cfg["voice_id"]
-                content = strip_speaker_label(line)
-                
-                if not voice_id:
-                    continue
-                
-                try:
-                    audio_data = text_to_audio_elevenlabs(text=content, voice_id=voice_id)
-                    audio_segments.append(audio_data)
-                    processed_lines += 1
-                    
-                    progress = 60 + (processed_lines / total_lines) * 35
-                    processing_status[task_id]['progress'] = min(progress, 95)
-                    processing_status[task_id]['status'] = f'Processing audio ({processed_lines}/{total_lines})...'
-                    
-                except Exception as e:
-                    print(f"Error processing line: {e}")
-                    continue
+            cfg, content = parsed
+            if not cfg["voice_id"]:
+                continue
+            
+            dialogue.append((cfg["voice_id"], content))
+        
+        total_lines = len(dialogue)
+        processed_lines = 0
+        progress_lock = threading.Lock()
+        
+        def synthesize(item):
+            nonlocal processed_lines
+            voice_id, content = item
+            segment = tempfile.NamedTemporaryFile(suffix='.mp3', delete=False)
+            try:
+                with segment:
+                    text_to_audio_elevenlabs(text=content, voice_id=voice_id, out_fh=segment)
+            except Exception as e:
+                print(f"Error processing line: {e}")
+                os.unlink(segment.name)
+                return None
+            
+            with progress_lock:
+                processed_lines += 1
+                progress = 60 + (processed_lines / total_lines) * 35
+                update_status(
+                    task_id,
+                    progress=min(progress, 95),
+                    status=f'Processing audio ({processed_lines}/{total_lines})...'
+                )
+            return segment.name
         
-        processing_status[task_id]['status'] = 'Finalizing podcast...'
-        processing_status[task_id]['progress'] = 95
+        # executor.map yields results in submission order, so the segments
+        # still line up with the script even though the calls overlap.
+        with ThreadPoolExecutor(max_workers=TTS_WORKERS) as executor:
+            segment_paths = [path for path in executor.map(synthesize, dialogue) if path]
+        
+        update_status(task_id, status='Finalizing podcast...', progress=95)
         
         # Simple concatenation of audio segments
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -354,18 +887,25 @@ def process_podcast_creation(pdf_path: str, task_id: str):
         
         # Write concatenated audio to file
         with open(output_path, 'wb') as output_file:
-            for segment in audio_segments:
-                output_file.write(segment)
+            for index, segment_path in enumerate(segment_paths):
+                append_segment(output_file, segment_path, keep_id3=index == 0)
+                os.unlink(segment_path)
         
-        processing_status[task_id]['status'] = 'Complete!'
-        processing_status[task_id]['progress'] = 100
-        processing_status[task_id]['download_url'] = f'/download/{output_filename}'
-        processing_status[task_id]['filename'] = output_filename
+        update_status(
+            task_id,
+            status='Complete!',
+            progress=100,
+            download_url=f'/download/{output_filename}',
+            filename=output_filename
+        )
         
     except Exception as e:
-        processing_status[task_id]['status'] = f'Error: {str(e)}'
-        processing_status[task_id]['progress'] = 0
-        processing_status[task_id]['error'] = True
+        update_status(
+            task_id,
+            status=f'Error: {str(e)}',
+            progress=0,
+            error=True
+        )
 
 @app.route('/')
 def index():
@@ -570,7 +1110,7 @@ def index():
                 .then(data => {
                     if (data.task_id) {
                         currentTaskId = data.task_id;
-                        checkStatus();
+                        watchStatus();
                     } else {
                         alert('Upload failed: ' + data.error);
                         // Show API status if configuration error
@@ -585,29 +1125,59 @@ def index():
                 });
             }
             
+            // Renders a status payload; returns true once the task is finished.
+            function renderStatus(data) {
+                document.getElementById('progressFill').style.width = data.progress + '%';
+                document.getElementById('statusText').textContent = data.status;
+                
+                if (data.progress >= 100 && data.download_url) {
+                    document.getElementById('downloadSection').classList.remove('hidden');
+                    document.getElementById('audioPlayer').src = data.download_url;
+                    
+                    // Store filename for direct download
+                    if (data.filename) {
+                        document.getElementById('downloadBtn').onclick = function() {
+                            window.location.href = `/download/${data.filename}`;
+                        };
+                    }
+                    return true;
+                } else if (data.error) {
+                    alert('Processing failed: ' + data.status);
+                    return true;
+                }
+                return false;
+            }
+            
+            function watchStatus() {
+                if (!currentTaskId) return;
+                
+                if (!window.EventSource) {
+                    checkStatus();
+                    return;
+                }
+                
+                // The server pushes every status change; fall back to polling
+                // if the stream can't be opened or drops before completion.
+                const events = new EventSource(`/events/${currentTaskId}`);
+                events.onmessage = function(event) {
+                    if (renderStatus(JSON.parse(event.data))) {
+                        events.close();
+                    }
+                };
+                events.onerror = function() {
+                    events.close();
+                    checkStatus();
+                };
+            }
+            
             function checkStatus() {
                 if (!currentTaskId) return;
                 
                 fetch(`/status/${currentTaskId}`)
                 .then(response => response.json())
                 .then(data => {
-                    document.getElementById('progressFill').style.width = data.progress + '%';
-                    document.getElementById('statusText').textContent = data.status;
-                    
-                    if (data.progress >= 100 && data.download_url) {
-                        document.getElementById('downloadSection').classList.remove('hidden');
-                        document.getElementById('audioPlayer').src = data.download_url;
-                        
-                        // Store filename for direct download
-                        if (data.filename) {
-                            document.getElementById('downloadBtn').onclick = function() {
-                                window.location.href = `/download/${data.filename}`;
-                            };
-                        }
-                    } else if (!data.error) {
+                    if (!renderStatus(data)) {
                         setTimeout(checkStatus, 2000);
-                    } else {
-                        alert('Processing failed: ' + data.status);
                     }
                 })
                 .catch(error => {
@@ -643,12 +1213,6 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         num_hosts = int(request.form.get('num_hosts', 2))
         num_guests = int(request.form.get('num_guests', 1))
         podcast_length = int(request.form.get('podcast_length', 10))  # in minutes
@@ -661,21 +1225,34 @@ def upload_file():
         if podcast_length < 3 or podcast_length > 15:
             return jsonify({'error': 'Podcast length must be between 3 and 15 minutes'}), 400
         
-        task_id = f"task_{timestamp}_{random.randint(1000, 9999)}"
+        if not pending_tasks.acquire(blocking=False):
+            return jsonify({'error': 'Server is busy. Please try again in a few minutes.'}), 429
         
-        processing_status[task_id] = {
-            'status': 'Starting...',
-            'progress': 0,
-            'error': False,
-            'num_hosts': num_hosts,
-            'num_guests': num_guests,
-            'podcast_length': podcast_length,
-            'selected_hosts': selected_hosts
-        }
+        task_id = secrets.token_urlsafe(16)
         
-        thread = threading.Thread(target=process_podcast_creation, args=(filepath, task_id))
-        thread.daemon = True
-        thread.start()
+        create_status(
+            task_id,
+            status='Starting...',
+            progress=0,
+            error=False,
+            num_hosts=num_hosts,
+            num_guests=num_guests,
+            podcast_length=podcast_length,
+            selected_hosts=selected_hosts
+        )
+        
+        # The task id keeps concurrent uploads of the same file apart; each
+        # task deletes its own upload as soon as the text is extracted.
+        filename = f"{task_id}_{secure_filename(file.filename)}"
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        try:
+            file.save(filepath)
+        except Exception:
+            pending_tasks.release()
+            raise
+        
+        future = task_executor.submit(process_podcast_creation, filepath, task_id)
+        future.add_done_callback(lambda f: pending_tasks.release())
         
         return jsonify({'task_id': task_id})
     
@@ -683,16 +1260,53 @@ def upload_file():
 
 @app.route('/status/<task_id>')
 def get_status(task_id):
-    if task_id in processing_status:
-        return jsonify(processing_status[task_id])
+    task = get_task_status(task_id)
+    if task is not None:
+        return jsonify(task)
     else:
         return jsonify({'error': 'Task not found'}), 404
 
+def stream_status(task_id: str):
+    version = None
+    while True:
+        with status_changed:
+            status_changed.wait_for(
+                lambda: status_versions.get(task_id) != version,
+                timeout=STATUS_KEEPALIVE
+            )
+            current = status_versions.get(task_id)
+            task = processing_status.get(task_id)
+            task = dict(task) if task is not None else None
+        
+        if task is None:
+            return
+        if current == version:
+            # Comment line to keep proxies from closing an idle connection.
+            yield ": keep-alive\n\n"
+            continue
+        
+        version = current
+        yield f"data: {json.dumps(task)}\n\n"
+        if task.get('error') or task.get('download_url'):
+            return
+
+@app.route('/events/<task_id>')
+def status_events(task_id):
+    if get_task_status(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    return Response(
+        stream_status(task_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/download/<identifier>')
 def download_file(identifier):
     try:
-        if identifier in processing_status and 'filename' in processing_status[identifier]:
-            filename = processing_status[identifier]['filename']
+        task = get_task_status(identifier)
+        if task is not None and 'filename' in task:
+            filename = task['filename']
         else:
             filename = identifier
         